@@ -1,24 +1,33 @@
 import feedparser
-from openai import OpenAI
+import functools
+import gzip
+from openai import AsyncOpenAI, OpenAI
 import openai
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
 import random
 import os
-import json
 import time
-from datetime import datetime
-import requests
-from bs4 import BeautifulSoup
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import httpx
+import lmdb
+from selectolax.lexbor import LexborHTMLParser as HTMLParser
+import numpy as np
+import orjson
 import re
-import shelve
+import sqlite3
+import tempfile
+import tiktoken
 import xxhash
-import threading
-from queue import Queue
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 
 def load_config(config_path="config.json"):
     """Load the configuration from a JSON file."""
-    with open(config_path, "r") as config_file:
-        config = json.load(config_file)
+    with open(config_path, "rb") as config_file:
+        config = orjson.loads(config_file.read())
     return config
 
 
@@ -31,47 +40,213 @@ try:
     SUMMARY_MODEL = config["summary_model"]
     RET_LANGUAGE = config["language"]
     BSIZE = config["batch_size"]
-    PSIZE = config["process_size"]
+    FILTER_TOKEN_TARGET = config.get("filter_token_target", 1000)
     MAX_TOKENS = config["max_tokens"]
+    MAX_INPUT_TOKENS = config.get("max_input_tokens", 4000)
     MYKEY = config["api_key"]
     daily_base_path = config["daily_base_path"]
     db_path = config["db_path"]
+    cache_path = config.get("cache_path", f"{db_path}.cache")
+    page_cache_path = config.get("page_cache_path", f"{db_path}.pages")
+    PAGE_CACHE_TTL = config.get("page_cache_ttl", 7 * 24 * 3600)
+    EMBEDDING_MODEL = config.get("embedding_model", "text-embedding-3-small")
+    SEMANTIC_THRESHOLD = config.get("semantic_threshold", 0.92)
+    INTEREST_THRESHOLD = config.get("interest_threshold")
+    MODE = config.get("mode", "batch")
+    BATCH_POLL_INTERVAL = config.get("batch_poll_interval", 30)
+    CONCURRENCY = config.get("concurrency")
+    MAX_REQUESTS_PER_MINUTE = config.get("max_requests_per_minute", 500)
+    MAX_TOKENS_PER_MINUTE = config.get("max_tokens_per_minute", 200000)
 except KeyError:
     print("Configuration file is missing required fields.")
     exit(1)
+# Tokens reserved for the system prompt and message framing of a summary request
+PROMPT_OVERHEAD = 64
+
+# Rough number of characters per token when estimating prompt sizes
+CHARS_PER_TOKEN = 4
 # Adjust this regex pattern to match your ID format if necessary
-id_pattern = re.compile(r"^\d+:\s")
+id_pattern = re.compile(r"^(\d+):\s", re.MULTILINE)
+# Query parameters that only track where a link was shared from
+TRACKING_PARAMS = {"fbclid", "gclid", "mc_cid", "mc_eid", "ref", "source", "spm"}
+
+# Connection pool and limits shared by all article page fetches in a run
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=3.05)
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 0.3
+RETRY_STATUSES = {429, 502, 503, 504}
+MAX_PAGE_BYTES = 2 * 1024 * 1024
+# Durations such as "1s", "120ms" or "6m0s" in the OpenAI rate limit reset headers
+reset_pattern = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+RESET_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+# Longest wait after a summarization rate limit error, whatever the headers say
+MAX_RATE_LIMIT_DELAY = 60.0
+
+# Characters of each article embedded for the semantic cache
+EMBEDDING_INPUT_CHARS = 2000
+# Texts embedded per embeddings request
+EMBEDDING_BATCH_SIZE = 256
+
+# Feed content shorter than this is always treated as a snippet
+MIN_CONTENT_LENGTH = 200
+# Content up to this length that ends in a "read more" link is also a snippet
+TRUNCATED_CONTENT_LENGTH = 2000
+TRUNCATED_MARKERS = ("查看全文", "阅读全文", "Read more", "Continue reading")
+# Number of summaries written between fsyncs of the summary file
+FSYNC_EVERY = 8
+SUMMARY_BUFFER_SIZE = 1 << 20
+# Upper bound of the seen-title database; the file only grows as it fills up
+DB_MAP_SIZE = 1 << 30
+
+
+# One OpenAI client per flavour shares an HTTP/2 connection pool across all requests.
+# The async client is bound to the single event loop main() runs in.
+OPENAI_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+# Bounds hung requests; the SDK retries timeouts on its own
+OPENAI_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+CLIENT = OpenAI(
+    api_key=MYKEY,
+    http_client=httpx.Client(http2=True, limits=OPENAI_LIMITS, timeout=OPENAI_TIMEOUT),
+)
+ASYNC_CLIENT = AsyncOpenAI(
+    api_key=MYKEY,
+    http_client=httpx.AsyncClient(
+        http2=True, limits=OPENAI_LIMITS, timeout=OPENAI_TIMEOUT
+    ),
+)
+
+
+# Worker processes for CPU-bound HTML parsing, started on first use
+PARSE_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+
+def open_http_client():
+    """Opens the pooled HTTP client used to fetch article pages."""
+    # HTTP/2 multiplexes concurrent fetches from the same site over one connection
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            http2=True, limits=HTTP_LIMITS, retries=FETCH_RETRIES
+        ),
+        timeout=HTTP_TIMEOUT,
+        follow_redirects=True,
+    )
+
+
+def retry_delay(response, attempt):
+    """Returns how long to wait before retrying, honouring the Retry-After header."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return min(30.0, max(0.0, float(retry_after)))
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+                return min(30.0, max(0.0, delay))
+            except (TypeError, ValueError):
+                pass
+    return FETCH_BACKOFF * 2**attempt
+
 
+async def read_capped(response):
+    """Reads the streamed response body, stopping after MAX_PAGE_BYTES."""
+    chunks = []
+    size = 0
+    async for chunk in response.aiter_bytes():
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= MAX_PAGE_BYTES:
+            break
+    return b"".join(chunks)[:MAX_PAGE_BYTES]
 
-def fetch_article_content(url):
+
+def page_cache_file(url):
+    """Returns the path of the cached gzipped HTML for the given URL."""
+    digest = xxhash.xxh3_64_hexdigest(url.encode("utf-8"))
+    return os.path.join(page_cache_path, f"{digest}.html.gz")
+
+
+def load_cached_page(url):
+    """Returns the cached HTML of the given URL, or None if missing or expired."""
+    path = page_cache_file(url)
+    try:
+        if time.time() - os.path.getmtime(path) > PAGE_CACHE_TTL:
+            return None
+        with gzip.open(path, "rb") as f:
+            return f.read()
+    except (OSError, EOFError):
+        return None
+
+
+def prune_page_cache():
+    """Deletes the cached pages older than the page cache TTL."""
+    try:
+        entries = list(os.scandir(page_cache_path))
+    except FileNotFoundError:
+        return
+    expired_before = time.time() - PAGE_CACHE_TTL
+    removed = 0
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime < expired_before:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            pass
+    if removed:
+        print(f"Removed {removed} expired pages from the page cache.")
+
+
+def store_cached_page(url, content):
+    """Writes the fetched HTML of the given URL to the page cache."""
+    path = page_cache_file(url)
+    os.makedirs(page_cache_path, exist_ok=True)
+    # Write to a temporary file first so a crash never leaves a partial entry
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(gzip.compress(content, compresslevel=6))
+    os.replace(tmp_path, path)
+
+
+async def fetch_article_content(http_client, url):
     """Fetches the full article content from the given URL."""
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.content, "html.parser")
-        article_text = soup.get_text(strip=True)
-        return article_text
+        content = await asyncio.to_thread(load_cached_page, url)
+        if content is None:
+            for attempt in range(FETCH_RETRIES + 1):
+                async with http_client.stream("GET", url) as response:
+                    if (
+                        response.status_code in RETRY_STATUSES
+                        and attempt < FETCH_RETRIES
+                    ):
+                        await asyncio.sleep(retry_delay(response, attempt))
+                        continue
+                    response.raise_for_status()
+                    content = await read_capped(response)
+                    break
+            await asyncio.to_thread(store_cached_page, url, content)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(PARSE_POOL, extract_page_text, content)
     except Exception as e:
         print(f"An error occurred while fetching the article content: {e}")
         return ""
 
 
-def find_the_first_image(description):
-    """Finds the first image URL in the feed entry description."""
-    img_urls = re.findall(r'<img src="(.*?)"', description)
-    if img_urls:
-        return img_urls[0]
+def find_the_first_image(tree):
+    """Finds the first image URL in the parsed feed entry description."""
+    img = tree.css_first("img")
+    if img:
+        return img.attributes.get("src")
     return None
 
 
-def clean_html_content(html_content):
-    """Removes unnecessary HTML elements from the content."""
-    soup = BeautifulSoup(html_content, "lxml")
-
-    for script_or_style in soup(["script", "style"]):
+def clean_html_content(tree):
+    """Removes unnecessary HTML elements from the parsed content and returns its text."""
+    for script_or_style in tree.css("script, style"):
         script_or_style.decompose()
 
-    text = soup.get_text()
+    text = tree.text(separator="\n", strip=True)
 
     lines = (line.strip() for line in text.splitlines())
     chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
@@ -79,301 +254,1088 @@ def clean_html_content(html_content):
     return text
 
 
+@dataclass
+class Articles:
+    """Fetched articles stored column-wise; an article's id is its row index."""
+
+    title: list = field(default_factory=list)
+    link: list = field(default_factory=list)
+    published: list = field(default_factory=list)
+    updated: list = field(default_factory=list)
+    content: list = field(default_factory=list)
+    image: list = field(default_factory=list)
+    hash: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.uint64))
+    link_hash: np.ndarray = field(
+        default_factory=lambda: np.empty(0, dtype=np.uint64)
+    )
+
+    def __len__(self):
+        return len(self.title)
+
+
+def extract_page_text(html):
+    """Extracts the body text of a fetched article page."""
+    tree = HTMLParser(html)
+    if tree.body is None:
+        return ""
+    tree.strip_tags(["script", "style", "noscript"])
+    return tree.body.text(separator=" ", strip=True)
+
+
+def parse_entry_html(html_content):
+    """Parses a feed entry's HTML once for both its first image and cleaned text."""
+    tree = HTMLParser(html_content)
+    return find_the_first_image(tree), clean_html_content(tree)
+
+
+def fetch_feed(http_client, url):
+    """Downloads a feed over the shared connection pool and parses it."""
+    # Local files and other schemes are left to feedparser itself
+    if urlsplit(url).scheme not in ("http", "https"):
+        return feedparser.parse(url)
+    try:
+        response = http_client.get(url)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        return feedparser.FeedParserDict(bozo=True, bozo_exception=e, entries=[])
+    # The final URL lets feedparser resolve relative entry links as before
+    headers = dict(response.headers, **{"content-location": str(response.url)})
+    return feedparser.parse(response.content, response_headers=headers)
+
+
 def fetch_rss_articles(urls):
     """Fetches articles from the given RSS feed URLs."""
-    articles = []
-    count = 0
+    articles = Articles()
     img_count = 0
-    for url in urls:
-        print(f"Fetching articles from {url}...")
-        feed = feedparser.parse(url)
+    print(f"Fetching articles from {len(urls)} feeds...")
+    # Feeds on the same host share keep-alive connections across the workers
+    with httpx.Client(
+        http2=True,
+        limits=HTTP_LIMITS,
+        timeout=HTTP_TIMEOUT,
+        follow_redirects=True,
+        headers={"User-Agent": feedparser.USER_AGENT},
+    ) as http_client:
+        with ThreadPoolExecutor(max_workers=max(1, min(32, len(urls)))) as executor:
+            feeds = list(executor.map(lambda url: fetch_feed(http_client, url), urls))
+
+    entries = []
+    contents = []
+    for url, feed in zip(urls, feeds):
         if feed.bozo:
             print(f"Error fetching articles from {url}: {feed.bozo_exception}")
             continue
 
         for entry in feed.entries:
-            article = {
-                "id": count,
-                "title": entry.title,
-                "link": entry.link,
-                "published": entry.get("published", ""),
-                "updated": entry.get("updated", ""),
-                "content": "",
-                "image": "",
-            }
-
+            content = ""
             # If 'content' is an array, merge all elements into a single string
             if hasattr(entry, "content") and isinstance(entry.content, list):
-                content_merged = "".join([item.value for item in entry.content])
-                article["content"] = content_merged
+                content = "".join([item.value for item in entry.content])
             elif hasattr(entry, "description"):
-                article["content"] = entry.description
+                content = entry.description
+            entries.append(entry)
+            contents.append(content)
+
+    # Clean the HTML content across processes, in chunks to amortize pickling
+    chunksize = max(1, len(contents) // (4 * (os.cpu_count() or 1)))
+    parsed = PARSE_POOL.map(parse_entry_html, contents, chunksize=chunksize)
 
+    # Assign ids serially in feed order to keep them deterministic
+    for entry, (image, text) in zip(entries, parsed):
+        if image:
+            img_count += 1
 
-            # Extracting the first image from the content
-            article["image"] = find_the_first_image(article["content"])
-            # Clean the HTML content
-            article["content"] = clean_html_content(article["content"])
-            if article["image"]:
-                # print(f"Found image: {article['image']}")
-                img_count += 1
+        articles.title.append(entry.title)
+        articles.link.append(entry.link)
+        articles.published.append(entry.get("published", ""))
+        articles.updated.append(entry.get("updated", ""))
+        articles.content.append(text)
+        articles.image.append(image)
 
-            articles.append(article)
-            count += 1
-    print(f"Fetched {count} articles, {img_count} with images.")
+    articles.hash = np.fromiter(
+        (hash_title(title) for title in articles.title),
+        dtype=np.uint64,
+        count=len(articles),
+    )
+    articles.link_hash = np.fromiter(
+        (
+            xxhash.xxh3_64_intdigest(canonical_link(link).encode("utf-8"))
+            for link in articles.link
+        ),
+        dtype=np.uint64,
+        count=len(articles),
+    )
+    print(f"Fetched {len(articles)} articles, {img_count} with images.")
     return articles
 
 
 def hash_title(title):
-    """Hashes the title using the xxHash algorithm."""
-    return xxhash.xxh64(title).hexdigest()
+    """Hashes the title to a 64-bit integer using the XXH3 algorithm."""
+    return xxhash.xxh3_64_intdigest(title.encode("utf-8"))
+
 
+def canonical_link(link):
+    """Normalizes a link so the same story shared by different feeds compares equal."""
+    parts = urlsplit(link.strip())
+    query = [
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.startswith("utm_") and key not in TRACKING_PARAMS
+    ]
+    return urlunsplit(
+        (
+            parts.scheme.lower(),
+            parts.netloc.lower(),
+            parts.path.rstrip("/"),
+            urlencode(query),
+            "",
+        )
+    )
 
-def store_hashed_titles(articles, db_path="hashed_titles"):
-    """store hashed titles in a shelve database"""
-    with shelve.open(db_path) as db:
-        for article in articles:
-            hashed_title = hash_title(article["title"])
-            db[hashed_title] = article["title"]
 
+def first_occurrences(hashes):
+    """Returns a mask selecting the first occurrence of each hash."""
+    _, first_indices = np.unique(hashes, return_index=True)
+    first_seen = np.zeros(len(hashes), dtype=bool)
+    first_seen[first_indices] = True
+    return first_seen
+
+
+def hash_keys(hashes):
+    """Encodes 64-bit hashes as the 8-byte little-endian keys of the seen store."""
+    packed = hashes.astype("<u8").tobytes()
+    return [packed[i : i + 8] for i in range(0, len(packed), 8)]
+
+
+class TitleStore:
+    """Seen title hashes and cached tag embeddings kept in an LMDB database."""
+
+    def __init__(self, path):
+        try:
+            self.env = lmdb.open(path, map_size=DB_MAP_SIZE, subdir=False, max_dbs=4)
+        except lmdb.InvalidError:
+            raise ValueError(
+                f"{path} is not an LMDB database, point db_path at a new file."
+            )
+        # Seen hashes live in the unnamed database, vectors in one named per model
+        self.vectors = self.env.open_db(f"vectors:{EMBEDDING_MODEL}".encode())
 
-def filter_new_articles(articles, db_path="hashed_titles"):
-    """Filters out articles that have already been logged."""
-    new_articles = []
-    with shelve.open(db_path) as db:
-        for article in articles:
-            hashed_title = hash_title(article["title"])
-            if hashed_title not in db:
-                new_articles.append(article)
-    print(f"Removed {len(articles) - len(new_articles)} old articles.")
-    return new_articles
+    def record(self, hashes):
+        """
+        Records the given hashes, returning a boolean array telling which of
+        them had not been seen before.
+        """
+        keys = hash_keys(hashes)
+        # Check and record in one write transaction, so a run commits once;
+        # only the presence of a key is stored
+        with self.env.begin(write=True) as txn:
+            cursor = txn.cursor()
+            found = {key for key, _ in cursor.getmulti(keys)}
+            new_keys = [key not in found for key in keys]
+            cursor.putmulti((key, b"") for key in keys if key not in found)
+        return np.array(new_keys, dtype=bool)
+
+    def get_vectors(self, hashes):
+        """Returns the cached embeddings of the text hashes, None where missing."""
+        keys = hash_keys(hashes)
+        with self.env.begin(db=self.vectors) as txn:
+            found = dict(txn.cursor().getmulti(keys))
+        return [
+            np.frombuffer(found[key], dtype=np.float32) if key in found else None
+            for key in keys
+        ]
+
+    def put_vectors(self, hashes, vectors):
+        """Caches the embeddings of the text hashes."""
+        with self.env.begin(write=True, db=self.vectors) as txn:
+            txn.cursor().putmulti(
+                zip(hash_keys(hashes), (vector.tobytes() for vector in vectors))
+            )
+
+    def close(self):
+        self.env.close()
+
+
+def filter_and_record(articles, seen):
+    """
+    Filters out articles that have already been logged, returning the ids of
+    the new articles after recording them in the seen store.
+    """
+    hashes = articles.hash
+    first_titles = first_occurrences(hashes)
+    # Record retitled copies of a link too, so they are not taken for new
+    # articles once the first copy drops out of its feed
+    mask = np.zeros(len(hashes), dtype=bool)
+    mask[first_titles] = seen.record(hashes[first_titles])
+    # Keep only the first occurrence of stories repeated across feeds, whether
+    # they share a title or a link
+    mask &= first_occurrences(articles.link_hash)
+
+    new_ids = np.nonzero(mask)[0]
+    print(f"Removed {len(articles) - len(new_ids)} old articles.")
+    return new_ids
 
 
 def extract_ids_from_response(response_text):
     """
     Extracts IDs from the response text, filtering out any preamble or non-ID lines.
     """
-    lines = response_text.split("\n")
-    ids = []
-    for line in lines:
-        match = id_pattern.match(line)
-        if match:
-            # Extract the ID part before the colon (:)
-            id_only = line.split(":", 1)[0].strip()
-            ids.append(id_only)
-    return ids
-
+    try:
+        return [int(id) for id in orjson.loads(response_text)["ids"]]
+    except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+        # Fall back to "<id>: <title>" lines, capturing the part before the colon
+        return [int(id) for id in id_pattern.findall(response_text)]
 
-def filter_by_interest(articles, interest_tags, noise_tags):
-    """Filters articles based on the user's interest tags. s"""
 
-    def chunked_iterable(iterable, size):
-        for i in range(0, len(iterable), size):
-            yield iterable[i : i + size]
+def run_batch_job(batch_requests):
+    """
+    Submits (custom_id, body) chat completion requests as a single Batch API job
+    and returns the response texts keyed by custom_id.
+    """
+    # Errors are reported as missing outputs, so callers fall back per request
+    # just like in sync mode
+    results = {}
+    try:
+        with tempfile.NamedTemporaryFile("w+b", suffix=".jsonl") as batch_file:
+            for custom_id, body in batch_requests:
+                line = {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": body,
+                }
+                batch_file.write(orjson.dumps(line, option=orjson.OPT_APPEND_NEWLINE))
+            batch_file.flush()
+            batch_file.seek(0)
+            # Upload the underlying file object, the SDK rejects the tempfile wrapper
+            input_file = CLIENT.files.create(file=batch_file.file, purpose="batch")
 
-    client = OpenAI(api_key=MYKEY)
-    interested_articles = []
+        batch = CLIENT.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        print(f"Submitted batch {batch.id} with {len(batch_requests)} requests.")
+        start_t = time.time()
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(BATCH_POLL_INTERVAL)
+            batch = CLIENT.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            if counts is None:
+                print(f"Batch {batch.id} is {batch.status}.")
+            else:
+                print(
+                    f"Batch {batch.id} is {batch.status} "
+                    f"({counts.completed}/{counts.total} done, {counts.failed} failed)."
+                )
 
-    # Prepare a mapping of title IDs to articles
-    title_id_map = {f"{article['id']}": article for article in articles}
+        if batch.status != "completed":
+            print(f"Batch {batch.id} ended with status {batch.status}.")
+        # Expired and cancelled batches still keep the results they completed
+        if not batch.output_file_id:
+            return results
 
-    for titles_chunk in chunked_iterable(list(title_id_map.keys()), BSIZE):
-        prompt_titles = [f"{id}: {title_id_map[id]['title']}" for id in titles_chunk]
-        print(f"Titles: {prompt_titles}")
-        prompt = "Filter titles by interest tags: {} and exclude by noise tags: {}\n\nTitles:\n{}\n".format(
-            interest_tags, noise_tags, "\n".join(prompt_titles)
+        # Parse the output line by line as it downloads instead of buffering it whole
+        with CLIENT.files.with_streaming_response.content(
+            batch.output_file_id
+        ) as output:
+            for line in output.iter_lines():
+                if not line.strip():
+                    continue
+                try:
+                    item = orjson.loads(line)
+                    custom_id = item["custom_id"]
+                    response = item.get("response")
+                    if not response or response.get("status_code") != 200:
+                        print(f"Request {custom_id} failed: {item.get('error')}")
+                        continue
+                    content = response["body"]["choices"][0]["message"]["content"]
+                except (orjson.JSONDecodeError, KeyError, IndexError, TypeError) as e:
+                    print(f"Skipping a malformed batch output line: {e}")
+                    continue
+                if content is None:
+                    print(f"Request {custom_id} returned no content.")
+                    continue
+                results[custom_id] = content.strip()
+        print(
+            f"Batch {batch.id}: {len(results)}/{len(batch_requests)} requests "
+            f"succeeded in {time.time() - start_t:.2f} seconds."
         )
+    except Exception as e:
+        print(f"An error occurred while running the batch job: {e}")
+    return results
+
+
+def build_filter_prompt(interest_tags, noise_tags):
+    """Builds the system prompt shared by every filter request of a run."""
+    return (
+        "You are a smart assistant that filters article titles "
+        "based on the user's interest tags. Specifically, you should exclude "
+        "titles that are advertisements, including promotions, sales, "
+        "sponsored content, and any other form of paid content.\n\n"
+        f"Filter titles by interest tags: {interest_tags} "
+        f"and exclude by noise tags: {noise_tags}\n\n"
+        "Each title is given as '<id>: <title>'. Reply with a JSON object "
+        'listing the ids of the titles to keep, like {"ids": [3, 17]}.'
+    )
+
+
+def build_filter_request(prompt_titles, system_prompt):
+    """Builds the chat completion request body for filtering a chunk of titles."""
+    # The static system prompt goes first so repeated requests share a cacheable
+    # prefix, and only the titles differ between chunks
+    return {
+        "model": FILTER_MODEL,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": "Titles:\n" + "\n".join(prompt_titles)},
+        ],
+        "temperature": 0.3,
+        "response_format": {"type": "json_object"},
+    }
+
+
+def pack_by_length(ids, lengths, budget, max_items):
+    """
+    Packs ids into chunks of at most max_items whose total length stays within
+    budget, placing the longest first into the first chunk with room.
+    """
+    chunks = []
+    chunk_lengths = []
+    for id in sorted(ids, key=lambda id: lengths[id], reverse=True):
+        for n, chunk in enumerate(chunks):
+            if len(chunk) < max_items and chunk_lengths[n] + lengths[id] <= budget:
+                chunk.append(id)
+                chunk_lengths[n] += lengths[id]
+                break
+        else:
+            chunks.append([id])
+            chunk_lengths.append(lengths[id])
+    return chunks
+
 
+async def filter_by_interest(articles, ids, interest_tags, noise_tags):
+    """Filters the given article ids based on the user's interest tags."""
+
+    async def request_filter(body):
         try:
-            response = client.chat.completions.create(
-                model=FILTER_MODEL,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": (
-                            "You are a smart assistant that filters article titles "
-                            "based on the user's interest tags. Specifically, you should exclude "
-                            "titles that are advertisements, including promotions, sales, "
-                            "sponsored content, and any other form of paid content."
-                        ),
-                    },
-                    {"role": "user", "content": prompt},
-                ],
-                temperature=0.3,
-            )
-            interested_ids_text = response.choices[0].message.content.strip()
+            try:
+                response = await ASYNC_CLIENT.chat.completions.create(**body)
+            except openai.BadRequestError as e:
+                if "response_format" not in body:
+                    raise
+                # Models without JSON mode reject response_format, and the id regex
+                # can still parse their plain replies
+                print(f"Retrying the filter request without JSON mode: {e}")
+                body = {k: v for k, v in body.items() if k != "response_format"}
+                response = await ASYNC_CLIENT.chat.completions.create(**body)
+            return response.choices[0].message.content.strip()
         except Exception as e:
             print(f"An error occurred: {e}")
+            return None
+
+    interested_ids = []
+
+    # Mark which article ids were offered and not picked yet, so the responses
+    # can only pick each of those once
+    candidates = np.zeros(len(articles), dtype=bool)
+    candidates[ids] = True
+
+    # Pack titles by length so each request carries close to the token target
+    title_lines = {id: f"{id}: {articles.title[id]}" for id in ids}
+    lengths = {id: len(line) + 1 for id, line in title_lines.items()}
+    ids_chunks = pack_by_length(
+        ids, lengths, FILTER_TOKEN_TARGET * CHARS_PER_TOKEN, BSIZE
+    )
+
+    system_prompt = build_filter_prompt(interest_tags, noise_tags)
+    filter_requests = []
+    for ids_chunk in ids_chunks:
+        prompt_titles = [title_lines[id] for id in ids_chunk]
+        print(f"Titles: {prompt_titles}")
+        filter_requests.append(build_filter_request(prompt_titles, system_prompt))
+
+    if MODE == "batch":
+        outputs = await asyncio.to_thread(
+            run_batch_job, [(str(n), body) for n, body in enumerate(filter_requests)]
+        )
+        responses = [outputs.get(str(n)) for n in range(len(filter_requests))]
+    else:
+        # All chunks are independent, so send them at once
+        responses = await asyncio.gather(
+            *(request_filter(body) for body in filter_requests)
+        )
+
+    for interested_ids_text in responses:
+        if interested_ids_text is None:
             continue
 
-        interested_ids = extract_ids_from_response(interested_ids_text)
-        print(f"Interested IDs: {interested_ids}")
+        response_ids = extract_ids_from_response(interested_ids_text)
+        print(f"Interested IDs: {response_ids}")
 
         # Continue with filtering articles based on the extracted interested IDs
-        interested_articles.extend(
-            title_id_map[id] for id in interested_ids if id in title_id_map
+        for id in response_ids:
+            if 0 <= id < len(articles) and candidates[id]:
+                interested_ids.append(id)
+                # Unmark it to keep overlapping interest matches unique
+                candidates[id] = False
+
+    img_count = sum(1 for id in interested_ids if articles.image[id])
+    print(f"Filtered {len(interested_ids)} articles, {img_count} with images.")
+
+    # Packing reorders titles by length, return them in feed order
+    return sorted(interested_ids)
+
+
+async def embed_tags(tags, store):
+    """Embeds the tags, reusing the embeddings cached by earlier runs."""
+    hashes = np.fromiter((hash_title(tag) for tag in tags), dtype=np.uint64)
+    vectors = store.get_vectors(hashes)
+    missing = [n for n, vector in enumerate(vectors) if vector is None]
+    if missing:
+        new_vectors = await embed_texts([tags[n] for n in missing])
+        store.put_vectors(hashes[missing], new_vectors)
+        for n, vector in zip(missing, new_vectors):
+            vectors[n] = vector
+    return np.stack(vectors)
+
+
+async def filter_by_similarity(articles, ids, interest_tags, noise_tags, store):
+    """
+    Filters the given article ids by the cosine similarity of their titles to
+    the interest and noise tags, without asking the filter model.
+    """
+    try:
+        # Each title is only filtered once, so only the tags are worth caching
+        tag_vectors = await embed_tags(list(interest_tags) + list(noise_tags), store)
+        title_vectors = await embed_texts([articles.title[id] for id in ids])
+    except Exception as e:
+        # The titles are already recorded as seen, so do not drop them silently
+        print(f"An error occurred while embedding, using the filter model: {e}")
+        return await filter_by_interest(articles, ids, interest_tags, noise_tags)
+    scores = title_vectors @ tag_vectors.T
+    interest_scores = scores[:, : len(interest_tags)].max(axis=1)
+    keep = interest_scores > INTEREST_THRESHOLD
+    if noise_tags:
+        # Drop titles that are closer to a noise tag than to any interest tag
+        keep &= interest_scores >= scores[:, len(interest_tags) :].max(axis=1)
+
+    interested_ids = [int(id) for id in ids[keep]]
+    img_count = sum(1 for id in interested_ids if articles.image[id])
+    print(f"Filtered {len(interested_ids)} articles, {img_count} with images.")
+
+    return interested_ids
+
+
+class RateLimiter:
+    """Token bucket throttling the requests and tokens sent per minute."""
+
+    def __init__(self, max_requests_per_minute, max_tokens_per_minute):
+        self.max_requests = max_requests_per_minute
+        self.max_tokens = max_tokens_per_minute
+        self.available_requests = max_requests_per_minute
+        self.available_tokens = max_tokens_per_minute
+        self.last_update = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.available_requests = min(
+            self.max_requests,
+            self.available_requests + elapsed * self.max_requests / 60,
         )
+        self.available_tokens = min(
+            self.max_tokens,
+            self.available_tokens + elapsed * self.max_tokens / 60,
+        )
+        self.last_update = now
+
+    async def acquire(self, tokens):
+        """Waits until both a request and the given number of tokens are available."""
+        tokens = min(tokens, self.max_tokens)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self.available_requests) * 60 / self.max_requests,
+                    (tokens - self.available_tokens) * 60 / self.max_tokens,
+                )
+                await asyncio.sleep(wait)
+
+
+class ConcurrencyController:
+    """
+    Bounds the in-flight requests and tunes the bound with AIMD: it grows while
+    latency and success rate hold, and halves on rate limiting.
+    """
+
+    def __init__(self, initial=8, minimum=4, maximum=64, window=8, cooldown=10):
+        self.concurrency = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.cooldown = cooldown
+        self.cooldown_until = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.succeeded = 0
+        self.latency_ewma = None
+        self.baseline_latency = None
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.concurrency)
+            self.in_flight += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def _set_concurrency(self, concurrency, reason):
+        if concurrency != self.concurrency:
+            print(f"Concurrency {self.concurrency} -> {concurrency} ({reason}).")
+            self.concurrency = concurrency
+
+    def _complete(self, success):
+        self.completed += 1
+        self.succeeded += success
+        if self.completed < self.window:
+            return
+        success_rate = self.succeeded / self.completed
+        self.completed = self.succeeded = 0
+        if time.monotonic() < self.cooldown_until or success_rate <= 0.98:
+            return
+        if self.baseline_latency and self.latency_ewma > self.baseline_latency * 1.1:
+            return
+        self.baseline_latency = self.latency_ewma
+        self._set_concurrency(
+            min(self.maximum, self.concurrency + 2),
+            f"latency {self.latency_ewma:.2f}s, success rate {success_rate:.0%}",
+        )
+
+    def record_success(self, latency):
+        """Records a completed request and its latency."""
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma = 0.8 * self.latency_ewma + 0.2 * latency
+        self._complete(True)
+
+    def record_failure(self):
+        """Records a request that failed for reasons other than rate limiting."""
+        self._complete(False)
+
+    def back_off(self):
+        """Halves the concurrency after hitting the rate limit."""
+        # Requests already in flight hit the same limit; halve once per cooldown
+        if time.monotonic() < self.cooldown_until:
+            return
+        self.cooldown_until = time.monotonic() + self.cooldown
+        self.completed = self.succeeded = 0
+        self._set_concurrency(max(self.minimum, self.concurrency // 2), "rate limited")
+
+
+async def embed_texts(texts):
+    """Embeds the texts, returning a float32 matrix with one unit-length row per text."""
+    vectors = []
+    for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        response = await ASYNC_CLIENT.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=[text or " " for text in texts[i : i + EMBEDDING_BATCH_SIZE]],
+        )
+        vectors.extend(item.embedding for item in response.data)
+    matrix = np.array(vectors, dtype=np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+class SemanticCache:
+    """Finds the summaries of near-duplicate articles by cosine similarity of their embeddings."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(hash BLOB PRIMARY KEY, model TEXT, vector BLOB, summary TEXT)"
+        )
+        rows = self.conn.execute(
+            "SELECT vector, summary FROM embeddings WHERE model = ?",
+            (EMBEDDING_MODEL,),
+        ).fetchall()
+        self.summaries = [summary for _, summary in rows]
+        self.matrix = np.array(
+            [np.frombuffer(vector, dtype=np.float32) for vector, _ in rows]
+        )
+        # Vectors of cache misses, stored once their summary is known
+        self.pending = {}
+
+    def search(self, vector):
+        """Returns the summary of the most similar cached article above the threshold."""
+        if not self.summaries:
+            return None
+        similarities = self.matrix @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < SEMANTIC_THRESHOLD:
+            return None
+        return self.summaries[best]
+
+    def add(self, key, summary):
+        """Stores the pending vector of a newly summarized article."""
+        vector = self.pending.pop(key, None)
+        if vector is None:
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+            (key, EMBEDDING_MODEL, vector.tobytes(), summary),
+        )
+        self.summaries.append(summary)
+        self.matrix = np.vstack([self.matrix.reshape(-1, len(vector)), vector])
+
+
+class SummaryCache:
+    """
+    SQLite cache of summaries: an exact lookup by a hash of the article link
+    and content, backed by a semantic lookup for near-duplicate articles.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS summaries "
+            "(hash BLOB PRIMARY KEY, summary TEXT, ts INTEGER)"
+        )
+        self.semantic = SemanticCache(self.conn) if SEMANTIC_THRESHOLD else None
+
+    @staticmethod
+    def key(link, content):
+        """Hashes the link and feed content with XXH3-128 to avoid collisions over time."""
+        return xxhash.xxh3_128_digest(link.encode() + b"\0" + content.encode())
 
-    # Ensure uniqueness in case of overlapping interest matches
-    interested_articles = list(
-        {article["id"]: article for article in interested_articles}.values()
+    def get(self, key):
+        row = self.conn.execute(
+            "SELECT summary FROM summaries WHERE hash = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    async def lookup(self, articles, ids):
+        """Returns the cached summaries of the given articles keyed by id."""
+        hits = {}
+        misses = []
+        for id in ids:
+            key = self.key(articles.link[id], articles.content[id])
+            summary = self.get(key)
+            if summary is None:
+                misses.append((id, key))
+            else:
+                hits[id] = summary
+        print(f"Exact cache hits: {len(hits)}/{len(ids)}.")
+        # Snippets are little more than the title, so serial posts such as
+        # consecutive issues would match each other
+        misses = [
+            (id, key) for id, key in misses if not is_truncated(articles.content[id])
+        ]
+        if not misses or self.semantic is None:
+            return hits
+
+        texts = [
+            f"{articles.title[id]}\n{articles.content[id]}"[:EMBEDDING_INPUT_CHARS]
+            for id, _ in misses
+        ]
+        try:
+            vectors = await embed_texts(texts)
+        except Exception as e:
+            print(f"An error occurred while embedding the articles: {e}")
+            return hits
+        semantic_hits = 0
+        for (id, key), vector in zip(misses, vectors):
+            summary = self.semantic.search(vector)
+            if summary is None:
+                self.semantic.pending[key] = vector
+            else:
+                hits[id] = summary
+                semantic_hits += 1
+        print(f"Semantic cache hits: {semantic_hits}/{len(misses)}.")
+        return hits
+
+    def put(self, key, summary):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)",
+            (key, summary, int(time.time())),
+        )
+        if self.semantic is not None:
+            self.semantic.add(key, summary)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def parse_reset(value):
+    """Parses a rate limit reset duration into seconds."""
+    return sum(
+        float(amount) * RESET_UNITS[unit]
+        for amount, unit in reset_pattern.findall(value)
     )
-    img_count = 0
-    for article in interested_articles:
-        if article["image"]:
-            img_count += 1
-    print(f"Filtered {len(interested_articles)} articles, {img_count} with images.")
 
-    return interested_articles
 
+def rate_limit_delay(headers):
+    """
+    Returns how long to wait after a rate limit error, using the reset time of
+    the exhausted limit reported in the x-ratelimit headers.
+    """
+    resets = {
+        limit: parse_reset(headers[f"x-ratelimit-reset-{limit}"])
+        for limit in ("requests", "tokens")
+        if headers.get(f"x-ratelimit-reset-{limit}")
+    }
+    exhausted = [
+        reset
+        for limit, reset in resets.items()
+        if headers.get(f"x-ratelimit-remaining-{limit}") == "0"
+    ]
+    # Wait for every limit to reset when the headers do not say which one ran out
+    delays = exhausted or list(resets.values())
+    if not delays:
+        try:
+            delays = [float(headers.get("retry-after"))]
+        except (TypeError, ValueError):
+            return random.randint(1, 10)
+    # Daily limits can report resets hours away, retry sooner rather than stall
+    return min(MAX_RATE_LIMIT_DELAY, max(delays)) + random.uniform(0, 0.5)
 
-def process_batch(tid, batch, summary_queue):
-    """Processes a batch of articles and generates summaries."""
-    client = OpenAI(api_key=MYKEY)
-    summaries = []
-    skipped_count = 0
 
-    print(f"T-{tid}: started processing a new batch...")
-    start_t = time.time()
-    for article in batch:
-        article_content = article["content"]
-        if article["link"] and len(article_content) < 200:
-            print(f"T-{tid}: Fetching article content from {article['link']}...")
-            article_content += fetch_article_content(article["link"])
-            print(f"New article is now {len(article_content)} characters long.")
-
-        prompt_message = (
-            "Exclude any references to author publicity and promotion and "
-            "the summary should be straightforward within 50 to 200 characters "
-            f"in {RET_LANGUAGE}."
+def estimate_tokens(body):
+    """Estimates the tokens consumed by a request body."""
+    encoding = summary_encoding()
+    if encoding is None:
+        # Character counts undercount CJK text several times over, while UTF-8
+        # bytes never undercount byte-level BPE tokens
+        return sum(len(message["content"].encode()) for message in body["messages"])
+    return sum(len(encoding.encode(message["content"])) for message in body["messages"])
+
+
+def is_truncated(content):
+    """Checks whether the feed content is only a snippet of the article."""
+    if len(content) < MIN_CONTENT_LENGTH:
+        return True
+    return len(content) < TRUNCATED_CONTENT_LENGTH and any(
+        marker in content for marker in TRUNCATED_MARKERS
+    )
+
+
+async def load_article_content(articles, id, http_client):
+    """Returns the article content, fetching the full text when the feed only has a snippet."""
+    article_content = articles.content[id]
+    link = articles.link[id]
+    if link and is_truncated(article_content):
+        print(f"Fetching article content from {link}...")
+        article_content = (
+            await fetch_article_content(http_client, link) or article_content
         )
+        print(f"New article is now {len(article_content)} characters long.")
+    return article_content
 
-        attempt = 0
-        while attempt < 3:
-            try:
-                response = client.chat.completions.create(
-                    model=SUMMARY_MODEL,
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": prompt_message,
-                        },
-                        {
-                            "role": "user",
-                            "content": article_content,
-                        },
-                    ],
-                    temperature=0.7,
-                )
+
+@functools.lru_cache(maxsize=None)
+def summary_encoding():
+    """
+    Loads the tokenizer of the summary model on first use, returning None if it
+    cannot be loaded so callers fall back to counting UTF-8 bytes.
+    """
+    # tiktoken downloads the BPE file the first time, which fails when offline
+    try:
+        try:
+            return tiktoken.encoding_for_model(SUMMARY_MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"Failed to load the tokenizer, counting UTF-8 bytes instead: {e}")
+        return None
+
+
+def truncate_to_budget(article_content):
+    """Truncates the article content to the input token budget left after the prompt."""
+    budget = max(1, MAX_INPUT_TOKENS - PROMPT_OVERHEAD)
+    # Byte-level BPE never yields more tokens than bytes, so short content fits as is
+    if len(article_content.encode()) <= budget:
+        return article_content
+    encoding = summary_encoding()
+    if encoding is None:
+        # Cut by UTF-8 bytes, which never undercount tokens, as estimate_tokens does
+        return article_content.encode()[:budget].decode("utf-8", "ignore")
+    tokens = encoding.encode(article_content)
+    if len(tokens) <= budget:
+        return article_content
+    return encoding.decode(tokens[:budget])
+
+
+def build_summary_request(article_content):
+    """Builds the chat completion request body for summarizing an article."""
+    prompt_message = (
+        "Exclude any references to author publicity and promotion and "
+        "the summary should be straightforward within 50 to 200 characters "
+        f"in {RET_LANGUAGE}."
+    )
+    return {
+        "model": SUMMARY_MODEL,
+        "messages": [
+            {
+                "role": "system",
+                "content": prompt_message,
+            },
+            {
+                "role": "user",
+                "content": truncate_to_budget(article_content),
+            },
+        ],
+        "temperature": 0.7,
+    }
+
+
+def format_summary(articles, id, summary_text):
+    """Formats the summary of an article as a markdown section."""
+    link = articles.link[id]
+    summary = (
+        f"### {articles.title[id]}\n\n"
+        f"- **链接**: [{link}]({link})\n"
+        f"- **摘要**: {summary_text}\n"
+    )
+    if articles.image[id]:
+        summary += f"- **图片**: ![]({articles.image[id]})\n\n"
+    return summary
+
+
+async def summarize_article(articles, id, controller, http_client, limiter):
+    """Summarizes a single article, returning the summary text and whether it was skipped."""
+    article_content = await load_article_content(articles, id, http_client)
+    body = build_summary_request(article_content)
+
+    attempt = 0
+    while attempt < 3:
+        try:
+            async with controller:
+                await limiter.acquire(estimate_tokens(body))
+                request_start = time.monotonic()
+                response = await ASYNC_CLIENT.chat.completions.create(**body)
                 summary_text = response.choices[0].message.content.strip()
-                break
-            except openai.BadRequestError:
-                print(
-                    f"T-{tid}: Bad request error, skipping the article and using the original content."
-                )
-                summary_text = article_content[:200]
-                print(f"The malfunctioning article: {article['title']}")
-                skipped_count += 1
-                break
-            except openai.RateLimitError:
-                time2sleep = random.randint(1, 10)
-                print(
-                    f"T-{tid}: Rate limit exceeded, waiting {time2sleep} seconds to retry..."
-                )
-                time.sleep(time2sleep)
-                attempt += 1
-            except Exception as e:
-                print(
-                    f"An error occurred while summarizing the article: {e}, using the original content."
-                )
-                summary_text = "Failed to summarize the article."
-                skipped_count += 1
-                break
-        if attempt == 3:
+                controller.record_success(time.monotonic() - request_start)
+            return summary_text, False
+        except openai.BadRequestError:
             print(
-                f"T-{tid}: Failed to summarize the article after 3 attempts, using the original content."
+                "Bad request error, skipping the article and using the original content."
             )
-            summary_text = article_content[:200]
-            skipped_count += 1
+            print(f"The malfunctioning article: {articles.title[id]}")
+            return article_content[:200], True
+        except openai.RateLimitError as e:
+            controller.back_off()
+            time2sleep = rate_limit_delay(e.response.headers)
+            print(f"Rate limit exceeded, waiting {time2sleep:.2f} seconds to retry...")
+            await asyncio.sleep(time2sleep)
+            attempt += 1
+        except Exception as e:
+            controller.record_failure()
+            print(
+                f"An error occurred while summarizing the article: {e}, using the original content."
+            )
+            return "Failed to summarize the article.", True
+    print(
+        "Failed to summarize the article after 3 attempts, using the original content."
+    )
+    return article_content[:200], True
 
-        summary = (
-            f"### {article['title']}\n\n"
-            f"- **链接**: [{article['link']}]({article['link']})\n"
-            f"- **摘要**: {summary_text}\n"
+
+async def summarize_articles(articles, ids, summary_queue, cache):
+    """
+    Summarizes the articles concurrently, auto-tuning concurrency unless it is
+    pinned, and queues each summary as soon as it is ready.
+    """
+    if CONCURRENCY:
+        controller = ConcurrencyController(CONCURRENCY, CONCURRENCY, CONCURRENCY)
+    else:
+        controller = ConcurrencyController()
+    limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE)
+
+    async def summarize_and_queue(id, http_client):
+        article_start = time.monotonic()
+        try:
+            summary_text, skipped = await summarize_article(
+                articles, id, controller, http_client, limiter
+            )
+        except Exception as e:
+            print(f"An error occurred while summarizing {articles.title[id]}: {e}")
+            summary_text, skipped = articles.content[id][:200], True
+        if not skipped:
+            cache.put(
+                SummaryCache.key(articles.link[id], articles.content[id]), summary_text
+            )
+        await summary_queue.put((id, format_summary(articles, id, summary_text)))
+        return skipped, time.monotonic() - article_start
+
+    start_t = time.time()
+    async with open_http_client() as http_client:
+        results = await asyncio.gather(
+            *(summarize_and_queue(id, http_client) for id in ids)
         )
-        if article["image"]:
-            summary += f"- **图片**: ![]({article['image']})\n\n"
-        summaries.append(summary)
+    elapsed = time.time() - start_t
+    skipped = sum(skip for skip, _ in results)
+    latencies = [latency for _, latency in results]
     print(
-        f"T-{tid}: {len(batch)} articles (skipped: {skipped_count}) summarized in {time.time() - start_t:.2f} seconds."
+        f"{len(ids)} articles (skipped: {skipped}) summarized in {elapsed:.2f} seconds."
     )
-    summary_queue.put(summaries)
-
+    if latencies and elapsed > 0:
+        # Overlap is the summed per-article latency over wall time, i.e. the
+        # effective number of articles in flight
+        print(
+            f"Throughput: {len(ids) / elapsed:.2f} articles/s, "
+            f"mean latency {sum(latencies) / len(latencies):.2f}s, "
+            f"max {max(latencies):.2f}s, overlap {sum(latencies) / elapsed:.1f}x."
+        )
+    if not CONCURRENCY:
+        print(
+            f"Settled at concurrency {controller.concurrency}, "
+            f'set "concurrency": {controller.concurrency} in config.json to pin it.'
+        )
 
-def generate_summary(articles, summary_path):
-    """Generates summaries for the given articles and logs the titles."""
-    summary_queue = Queue()
-    threads = []
 
-    tid = 0
-    for i in range(0, len(articles), PSIZE):
-        batch = articles[i : i + PSIZE]
-        thread = threading.Thread(
-            target=process_batch,
-            args=(tid, batch, summary_queue),
+async def generate_batch_summary(articles, ids, summary_queue, cache):
+    """Summarizes all the given articles through a single Batch API job."""
+    async with open_http_client() as http_client:
+        contents = await asyncio.gather(
+            *(load_article_content(articles, id, http_client) for id in ids)
         )
-        threads.append(thread)
-        thread.start()
-        tid += 1
+    contents = {str(id): content for id, content in zip(ids, contents)}
+    outputs = await asyncio.to_thread(
+        run_batch_job,
+        [
+            (custom_id, build_summary_request(content))
+            for custom_id, content in contents.items()
+        ],
+    )
+
+    skipped_count = 0
+    for id in ids:
+        custom_id = str(id)
+        summary_text = outputs.get(custom_id)
+        if summary_text is None:
+            print(f"Failed to summarize {articles.title[id]}, using the original content.")
+            summary_text = contents[custom_id][:200]
+            skipped_count += 1
+        else:
+            cache.put(
+                SummaryCache.key(articles.link[id], articles.content[id]), summary_text
+            )
+        await summary_queue.put((id, format_summary(articles, id, summary_text)))
+    print(f"{len(ids)} articles (skipped: {skipped_count}) summarized.")
 
-    for thread in threads:
-        thread.join()
 
-    summaries = []
-    while not summary_queue.empty():
-        summaries.extend(summary_queue.get())
+async def write_summaries(summary_path, summary_queue, ids):
+    """
+    Appends queued (id, summary) pairs to the summary file in the order of ids,
+    holding back summaries that complete early, until it receives None.
+    """
+    written = 0
+    pending = {}
+    order = iter(ids)
+    next_id = next(order, None)
+    # Buffer writes between fsyncs instead of flushing per 8 KiB block
+    with open(
+        summary_path, "a", encoding="utf-8", buffering=SUMMARY_BUFFER_SIZE
+    ) as summary_file:
+        while True:
+            item = await summary_queue.get()
+            if item is None:
+                break
+            id, summary = item
+            pending[id] = summary
+            while next_id in pending:
+                summary_file.write(pending.pop(next_id) + "\n")
+                next_id = next(order, None)
+                written += 1
+                if written % FSYNC_EVERY == 0:
+                    summary_file.flush()
+                    await asyncio.to_thread(os.fsync, summary_file.fileno())
+        # Write whatever is left in order if some summaries never arrived
+        for id in ids:
+            if id in pending:
+                summary_file.write(pending.pop(id) + "\n")
+                written += 1
+        summary_file.flush()
+        os.fsync(summary_file.fileno())
+    return written
 
-    summary_content = "\n".join(summaries)
-    with open(summary_path, "a") as summary_file:
-        summary_file.write(summary_content)
 
-    return summary_content
+async def generate_summary(articles, ids, summary_path):
+    """Generates summaries for the given articles and streams them to the summary file."""
+    summary_queue = asyncio.Queue()
+    writer = asyncio.create_task(write_summaries(summary_path, summary_queue, ids))
+    cache = SummaryCache(cache_path)
+    try:
+        # Reuse the summaries of articles already summarized in earlier runs
+        cached = await cache.lookup(articles, ids)
+        pending_ids = []
+        for id in ids:
+            if id in cached:
+                await summary_queue.put((id, format_summary(articles, id, cached[id])))
+            else:
+                pending_ids.append(id)
+        print(f"Reused {len(cached)} cached summaries.")
 
+        # Load the tokenizer off the event loop before the requests are built,
+        # since the first load may download its BPE file
+        if pending_ids:
+            await asyncio.to_thread(summary_encoding)
+        if pending_ids and MODE == "batch":
+            await generate_batch_summary(articles, pending_ids, summary_queue, cache)
+        elif pending_ids:
+            await summarize_articles(articles, pending_ids, summary_queue, cache)
+    finally:
+        cache.close()
+        await summary_queue.put(None)
+    return await writer
 
-def main():
+
+async def main():
+    prune_page_cache()
     articles = fetch_rss_articles(rss_urls)
-    new_articles = filter_new_articles(articles, db_path)
-    if not new_articles:
-        print("No new articles found.")
-        return
-    store_hashed_titles(articles, db_path)
+    store = TitleStore(db_path)
+    try:
+        new_ids = filter_and_record(articles, store)
+        if not len(new_ids):
+            print("No new articles found.")
+            return
 
-    interested_articles = filter_by_interest(new_articles, interest_tags, noise_tags)
-    num_articles = len(interested_articles)
+        if INTEREST_THRESHOLD is None:
+            interested_ids = await filter_by_interest(
+                articles, new_ids, interest_tags, noise_tags
+            )
+        else:
+            interested_ids = await filter_by_similarity(
+                articles, new_ids, interest_tags, noise_tags, store
+            )
+    finally:
+        store.close()
+    num_articles = len(interested_ids)
 
     today = datetime.now().strftime("%Y-%m-%d")
     os.makedirs(daily_base_path, exist_ok=True)
 
     summary_path = f"{daily_base_path}/{today}.md"
 
-    if num_articles > 64:
-        print(f"Too many articles ({num_articles}) matched the interest tags.")
-        for i in range(0, num_articles, 64):
-            assert 64 / PSIZE <= 16, "We only support 16 threads at most."
-            chunk = interested_articles[i : i + 64]
-            summary_content = generate_summary(chunk, summary_path)
-    elif num_articles == 0:
+    if num_articles == 0:
         print("No articles matched the interest tags.")
         return
-    else:
-        print(f"{num_articles} articles matched the interest tags.")
-        assert (
-            len(interested_articles) / PSIZE <= 16
-        ), "We only support 16 threads at most."
-        summary_content = generate_summary(interested_articles, summary_path)
+
+    print(f"{num_articles} articles matched the interest tags.")
+    await generate_summary(articles, interested_ids, summary_path)
 
     print(f"Daily summary generated and saved to {summary_path}")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())